@@ -0,0 +1,299 @@
+import json
+import time
+import random
+import shlex
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Bootstrap a whole Elasticsearch cluster from one spec file: prepare every node in
+# parallel, bring up the master, collect its enrollment token and join the other
+# nodes in parallel. Replaces running elasticsearch-cluster.sh by hand on each node.
+
+CONF_DIR = "/etc/elasticsearch"
+ES_CONFIG_FILE = f"{CONF_DIR}/elasticsearch.yml"
+ES_BIN = "/usr/share/elasticsearch/bin"
+MANAGED_MARKER = "# ---- managed by elasticsearch-cluster.py ----"
+
+REPO_FILE = """[elasticsearch]
+name=Elasticsearch repository for 8.x packages
+baseurl=https://artifacts.elastic.co/packages/8.x/yum
+gpgcheck=0
+gpgkey=https://artifacts.elastic.co/GPG-KEY-elasticsearch
+enabled=0
+autorefresh=1
+type=rpm-md
+"""
+
+class NodeError(Exception):
+    """Raised when a command fails on a node."""
+
+class SSHTransport:
+    """Run commands on a node over ssh."""
+
+    def __init__(self, host, user="root", **kwargs):
+        self.host = host
+        self.target = f"{user}@{host}"
+
+    def run(self, command, input=None):
+        """Run a shell command and return its exit code and output."""
+        result = subprocess.run(
+            ["ssh", "-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=accept-new", self.target, command],
+            input=input, capture_output=True, text=True,
+        )
+        return result.returncode, result.stdout + result.stderr
+
+class DryRunTransport:
+    """Stand-in node that only records and prints commands, answering the few queries the bootstrap makes."""
+
+    def __init__(self, host, user=None, mem_kb=16 * 1024 * 1024, **kwargs):
+        self.host = host
+        self.mem_kb = mem_kb
+        self.commands = []
+
+    def run(self, command, input=None):
+        self.commands.append(command)
+        print(f"[{self.host}] $ {command}")
+        if "/proc/meminfo" in command:
+            return 0, f"{self.mem_kb}\n"
+        if "elasticsearch-create-enrollment-token" in command:
+            return 0, f"dry-run-token-{self.host}\n"
+        if "curl" in command and "_cat/nodes" in command:
+            return 0, "node\n" * 1024
+        if "curl" in command:
+            return 0, "401"
+        return 0, ""
+
+TRANSPORTS = {"ssh": SSHTransport, "dry-run": DryRunTransport}
+
+def load_spec(path):
+    """Load the cluster spec.
+
+    {"cluster_name", "password", "data_dir", "log_dir",
+     "nodes": [{"host", "name", "master": true, "roles": [...]}, ...]}
+    The first node marked "master" (or the first node) bootstraps the cluster.
+    """
+    with open(path) as f:
+        spec = json.load(f)
+    spec.setdefault("cluster_name", "test-cluster")
+    spec.setdefault("data_dir", "/data/elasticsearch/data")
+    spec.setdefault("log_dir", "/data/elasticsearch/logs")
+    if "password" not in spec:
+        raise ValueError("The cluster spec needs the elastic user 'password'.")
+    if not spec.get("nodes"):
+        raise ValueError("The cluster spec has no nodes.")
+    for node in spec["nodes"]:
+        node.setdefault("name", node["host"])
+    return spec
+
+def bootstrap_node(spec):
+    """Return the node that forms the cluster and issues the enrollment token."""
+    return next((node for node in spec["nodes"] if node.get("master")), spec["nodes"][0])
+
+def size_node(mem_kb):
+    """Derive JVM heap and kernel settings from the RAM of a node.
+
+    The heap gets half of the RAM, capped below the 32 GB compressed-oops limit;
+    the rest is left to the filesystem cache. vm.max_map_count grows with RAM
+    from the 262144 Elasticsearch requires.
+    """
+    ram_mb = mem_kb // 1024
+    return {
+        "heap_mb": max(256, min(ram_mb // 2, 31 * 1024)),
+        "max_map_count": max(262144, ram_mb * 4),
+    }
+
+def node_settings(spec, node):
+    """Return the elasticsearch.yml settings this tool manages for one node."""
+    settings = {
+        "cluster.name": spec["cluster_name"],
+        "node.name": node["name"],
+        "path.data": spec["data_dir"],
+        "path.logs": spec["log_dir"],
+        "http.port": 9200,
+        "network.host": "0.0.0.0",
+        "transport.host": "0.0.0.0",
+        "discovery.seed_hosts": [f"{other['host']}:9300" for other in spec["nodes"]],
+        "bootstrap.memory_lock": True,
+        "http.cors.enabled": True,
+        "http.cors.allow-origin": "*",
+        "http.cors.allow-credentials": True,
+        "http.cors.allow-headers": "X-Requested-With, Content-Type, Content-Length, Authorization",
+    }
+    if node.get("roles"):
+        settings["node.roles"] = node["roles"]
+    if node is bootstrap_node(spec):
+        # only the bootstrap master may form a new cluster; joining nodes must not set this
+        settings["cluster.initial_master_nodes"] = [node["name"]]
+    return settings
+
+def render_config(existing, settings):
+    """Merge managed settings into an elasticsearch.yml.
+
+    Active lines for managed keys are dropped wherever they are, including inside
+    the security auto-configuration block, and the managed block is appended.
+    """
+    lines = []
+    for line in existing.splitlines():
+        if line.strip() == MANAGED_MARKER:
+            break
+        key = line.split(":", 1)[0].strip()
+        if not line.startswith("#") and key in settings:
+            continue
+        lines.append(line)
+    lines.append(MANAGED_MARKER)
+    for key, value in settings.items():
+        lines.append(f"{key}: {json.dumps(value)}")
+    return "\n".join(lines) + "\n"
+
+def run(transport, command, input=None):
+    """Run a command on a node and raise NodeError when it fails."""
+    code, output = transport.run(command, input=input)
+    if code != 0:
+        raise NodeError(f"{transport.host}: '{command}' exited with {code}: {output.strip()[-500:]}")
+    return output
+
+def write_file(transport, path, content):
+    """Write a file on a node."""
+    run(transport, f"cat > {shlex.quote(path)}", input=content)
+
+def wait_until(condition, timeout, initial_interval=1, max_interval=10):
+    """Call condition() with exponential backoff and jitter until it returns a truthy value or timeout."""
+    end_time = time.monotonic() + timeout
+    interval = initial_interval
+    while True:
+        result = condition()
+        if result:
+            return result
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(remaining, random.uniform(interval / 2, interval)))
+        interval = min(interval * 2, max_interval)
+
+def init_system(transport, sizing):
+    """Apply the kernel, limits, firewall and SELinux settings Elasticsearch needs."""
+    run(transport, "swapoff -a")
+    write_file(transport, "/etc/sysctl.d/99-elasticsearch.conf",
+               f"vm.swappiness=1\nvm.max_map_count={sizing['max_map_count']}\n")
+    run(transport, "sysctl --system >/dev/null")
+    run(transport, "systemctl disable --now firewalld.service || true")
+    run(transport, "sed -i 's/^SELINUX=.*/SELINUX=permissive/g' /etc/selinux/config && (setenforce 0 || true)")
+    write_file(transport, "/etc/security/limits.d/99-elasticsearch.conf",
+               "* soft nproc 1000000\n* hard nproc 1000000\n"
+               "* soft nofile 1000000\n* hard nofile 1000000\n"
+               "* soft memlock unlimited\n* hard memlock unlimited\n")
+
+def install_elasticsearch(spec, transport, sizing):
+    """Install the Elasticsearch package, its data directories, heap size and memlock limit."""
+    # remove a previous install first so yum installs the package again instead of skipping it
+    run(transport, "! rpm -q elasticsearch >/dev/null || yum remove -y elasticsearch")
+    run(transport, "rm -rf /etc/elasticsearch /var/lib/elasticsearch /usr/share/elasticsearch "
+                   f"{shlex.quote(spec['data_dir'])} {shlex.quote(spec['log_dir'])}")
+    run(transport, "rpm --import https://artifacts.elastic.co/GPG-KEY-elasticsearch")
+    write_file(transport, "/etc/yum.repos.d/elasticsearch.repo", REPO_FILE)
+    run(transport, "yum install --enablerepo=elasticsearch elasticsearch -y")
+    run(transport, f"mkdir -p {shlex.quote(spec['data_dir'])} {shlex.quote(spec['log_dir'])} && "
+                   f"chown -R elasticsearch:elasticsearch {shlex.quote(spec['data_dir'])} {shlex.quote(spec['log_dir'])}")
+    write_file(transport, f"{CONF_DIR}/jvm.options.d/heap.options",
+               f"-Xms{sizing['heap_mb']}m\n-Xmx{sizing['heap_mb']}m\n")
+    # limits.conf does not apply to systemd services, memory_lock needs this
+    run(transport, "mkdir -p /etc/systemd/system/elasticsearch.service.d")
+    write_file(transport, "/etc/systemd/system/elasticsearch.service.d/memlock.conf",
+               "[Service]\nLimitMEMLOCK=infinity\n")
+    run(transport, "systemctl daemon-reload && systemctl enable elasticsearch.service")
+
+def configure_elasticsearch(spec, node, transport):
+    """Back up elasticsearch.yml and merge the managed settings of this node into it."""
+    existing = run(transport, f"cp -f {ES_CONFIG_FILE} {ES_CONFIG_FILE}.$(date +%Y%m%d%H%M%S).bak && cat {ES_CONFIG_FILE}")
+    write_file(transport, ES_CONFIG_FILE, render_config(existing, node_settings(spec, node)))
+
+def prepare_node(spec, node, transport):
+    """Size, tune and install one node. Safe to run on all nodes at once."""
+    mem_kb = int(run(transport, "awk '/MemTotal/ {print $2}' /proc/meminfo").split()[0])
+    sizing = size_node(mem_kb)
+    print(f"[{node['name']}] {mem_kb // 1024} MB RAM: heap {sizing['heap_mb']} MB, "
+          f"vm.max_map_count {sizing['max_map_count']}")
+    init_system(transport, sizing)
+    install_elasticsearch(spec, transport, sizing)
+    print(f"[{node['name']}] installed")
+
+def wait_for_http(transport, timeout=300):
+    """Wait until the local node answers on its HTTP port (401 before login counts)."""
+    probe = "curl -sk -o /dev/null -w '%{http_code}' https://localhost:9200"
+    ready = wait_until(lambda: transport.run(probe)[1].strip() in ("200", "401"), timeout)
+    if not ready:
+        raise NodeError(f"{transport.host}: Elasticsearch did not come up within {timeout}s")
+
+def start_master(spec, node, transport):
+    """Configure and start the bootstrap master, set the elastic password and return a node enrollment token."""
+    configure_elasticsearch(spec, node, transport)
+    run(transport, "systemctl start elasticsearch.service")
+    wait_for_http(transport)
+    password = spec["password"]
+    run(transport, f"{ES_BIN}/elasticsearch-reset-password -u elastic -i", input=f"y\n{password}\n{password}\n")
+    token = run(transport, f"{ES_BIN}/elasticsearch-create-enrollment-token -s node").strip().splitlines()[-1]
+    print(f"[{node['name']}] master started, enrollment token collected")
+    return token
+
+def join_node(spec, node, transport, token):
+    """Enroll a node into the cluster with the master's token and start it."""
+    run(transport, f"{ES_BIN}/elasticsearch-reconfigure-node --enrollment-token {shlex.quote(token)}", input="y\n")
+    # reconfigure-node rewrites parts of elasticsearch.yml, so merge the managed settings afterwards
+    configure_elasticsearch(spec, node, transport)
+    run(transport, "systemctl start elasticsearch.service")
+    wait_for_http(transport)
+    print(f"[{node['name']}] joined")
+
+def wait_for_cluster(spec, transport, timeout=300):
+    """Wait until every node of the spec is part of the cluster."""
+    # credentials go through stdin as a curl config so they never show up in ps
+    command = "curl -sk -K - https://localhost:9200/_cat/nodes"
+    credentials = 'user = "elastic:{}"\n'.format(spec["password"].replace("\\", "\\\\").replace('"', '\\"'))
+    expected = len(spec["nodes"])
+    return wait_until(lambda: len(transport.run(command, input=credentials)[1].strip("\n").splitlines()) >= expected, timeout)
+
+def bootstrap_cluster(spec, transport_name="ssh", user="root", workers=8):
+    """Bootstrap the whole cluster described by the spec."""
+    transports = {node["name"]: TRANSPORTS[transport_name](node["host"], user) for node in spec["nodes"]}
+    master = bootstrap_node(spec)
+    others = [node for node in spec["nodes"] if node is not master]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # installation does not need the token, so every node is prepared at once
+        list(executor.map(lambda node: prepare_node(spec, node, transports[node["name"]]), spec["nodes"]))
+        token = start_master(spec, master, transports[master["name"]])
+        list(executor.map(lambda node: join_node(spec, node, transports[node["name"]], token), others))
+
+    if not wait_for_cluster(spec, transports[master["name"]]):
+        raise NodeError(f"Not all {len(spec['nodes'])} nodes joined the cluster in time")
+    # the cluster is formed, the bootstrap setting must not be reused on a later restart
+    run(transports[master["name"]], f"sed -i '/^cluster.initial_master_nodes:/d' {ES_CONFIG_FILE}")
+    print(f"Cluster {spec['cluster_name']} is up with {len(spec['nodes'])} nodes")
+
+# Parse command line arguments
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Bootstrap an Elasticsearch cluster from a JSON cluster spec.')
+    parser.add_argument('spec', help='Path of the cluster spec (JSON).')
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS), default='ssh', help='How to reach the nodes (default: ssh).')
+    parser.add_argument('--ssh-user', default='root', help='Remote user for the ssh transport (default: root).')
+    parser.add_argument('--workers', type=int, default=8, help='Nodes prepared or joined concurrently (default: 8).')
+    parser.add_argument('--print-config', action='store_true', help='Only print the managed elasticsearch.yml settings of every node.')
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    spec = load_spec(args.spec)
+
+    if args.print_config:
+        for node in spec["nodes"]:
+            print(f"# {node['name']} ({node['host']})")
+            print(render_config("", node_settings(spec, node)))
+        exit(0)
+
+    try:
+        bootstrap_cluster(spec, args.transport, args.ssh_user, args.workers)
+    except NodeError as e:
+        print(f"\033[91m{e}\033[0m")  # Red color for error messages
+        exit(1)
@@ -1,5 +1,19 @@
 import os
+import sys
+import json
+import time
+import queue
+import shlex
+import shutil
+import argparse
+import tempfile
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Bonding defaults for every bond, plus the ones that only apply to an LACP (802.3ad) uplink
+BOND_OPTIONS = "miimon=100"
+LACP_BOND_OPTIONS = "lacp_rate=fast,xmit_hash_policy=layer3+4"
 
 # Function to run shell commands with error handling
 def run_command(command, exit_on_failure=True):
@@ -28,65 +42,376 @@ def check_os_version():
         print("\033[91mUnable to detect OS version. Ensure you are running Rocky Linux 9.\033[0m")  # Red color for error messages
         exit(1)
 
-# Check the OS version before running the rest of the script
-check_os_version()
+def get_connection_info(interface, nmcli="nmcli"):
+    """Read the address with prefix, gateway and DNS servers of an interface from NetworkManager."""
+    output = subprocess.check_output(
+        [nmcli, "-t", "-f", "IP4.ADDRESS,IP4.GATEWAY,IP4.DNS", "device", "show", interface]
+    ).decode()
+    info = {"address": None, "gateway": None, "dns": []}
+    for line in output.splitlines():
+        key, _, value = line.partition(":")
+        key = key.split("[")[0]
+        if not value:
+            continue
+        if key == "IP4.ADDRESS" and info["address"] is None:
+            info["address"] = value
+        elif key == "IP4.GATEWAY":
+            info["gateway"] = value
+        elif key == "IP4.DNS":
+            info["dns"].append(value)
+    if info["address"] is None:
+        raise RuntimeError(f"Interface {interface} has no IPv4 address to move onto the bridge.")
+    return info
+
+def build_bridge_commands(interfaces, info, nmcli="nmcli", mtu=None, bond_mode=None, stp=True):
+    """Return the nmcli commands that move the uplink(s) and their address onto br0.
+
+    Without a bond mode the single interface is added to the bridge directly;
+    with one the interfaces are bonded into bond0 and the bond becomes the bridge port.
+    """
+    mtu_option = f" 802-3-ethernet.mtu {mtu}" if mtu else ""
+    stp_option = "" if stp else " bridge.stp no bridge.forward-delay 0"
+    ipv4_options = f"ipv4.addresses {info['address']} ipv4.method manual"
+    if info["gateway"]:
+        ipv4_options += f" ipv4.gateway {info['gateway']}"
+    if info["dns"]:
+        ipv4_options += f" ipv4.dns {','.join(info['dns'])}"
+
+    commands = [
+        f"{nmcli} connection add type bridge autoconnect yes con-name br0 ifname br0{stp_option}{mtu_option}",
+        f"{nmcli} connection modify br0 {ipv4_options}",
+    ]
+    if bond_mode:
+        bond_options = f"mode={bond_mode},{BOND_OPTIONS}"
+        if bond_mode == "802.3ad":
+            bond_options += f",{LACP_BOND_OPTIONS}"
+        commands.append(
+            f"{nmcli} connection add type bond autoconnect yes con-name bond0 ifname bond0 master br0 "
+            f"bond.options {bond_options}{mtu_option}"
+        )
+        for interface in interfaces:
+            commands.append(
+                f"{nmcli} connection add type bond-slave autoconnect yes con-name {interface}-slave "
+                f"ifname {interface} master bond0{mtu_option}"
+            )
+    else:
+        interface = interfaces[0]
+        commands.append(
+            f"{nmcli} connection add type bridge-slave autoconnect yes con-name {interface}-slave "
+            f"ifname {interface} master br0{mtu_option}"
+        )
+    commands.append(f"{nmcli} connection up br0")
+    return commands
+
+def build_vhost_net_commands():
+    """Return the commands that load vhost-net now and on every boot."""
+    return [
+        "modprobe vhost_net",
+        "echo vhost_net > /etc/modules-load.d/vhost_net.conf",
+    ]
+
+class SSHTransport:
+    """Run the installer on a remote host over ssh/scp."""
+
+    default_reboot_command = "systemctl reboot"
+
+    def __init__(self, host, user="root"):
+        self.host = host
+        self.target = f"{user}@{host}"
+        self.ssh_options = ["-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=accept-new", "-o", "ConnectTimeout=10"]
+
+    def stage(self, local_path, log):
+        """Copy the installer to the host and return its remote path."""
+        remote_path = "/tmp/install-kvm.py"
+        subprocess.run(["scp", "-q", *self.ssh_options, local_path, f"{self.target}:{remote_path}"],
+                       stdout=log, stderr=subprocess.STDOUT, check=True)
+        return remote_path
+
+    def run(self, command, log):
+        """Run a shell command on the host and return its exit code."""
+        return subprocess.call(["ssh", *self.ssh_options, self.target, command], stdout=log, stderr=subprocess.STDOUT)
+
+    def close(self):
+        """Nothing to clean up for ssh."""
+
+class LocalTransport:
+    """Stand-in transport that runs every "host" as a local subprocess in its own directory.
+
+    It never reboots by default and needs an explicit stand-in installer, so it cannot
+    run the real installer against this machine.
+    """
+
+    default_reboot_command = ""
+    requires_remote_script = True
+
+    def __init__(self, host, user=None):
+        self.host = host
+        self.workdir = tempfile.mkdtemp(prefix=f"install-kvm-{host}-")
+
+    def stage(self, local_path, log):
+        """Copy the installer into the host directory and return its path."""
+        remote_path = os.path.join(self.workdir, "install-kvm.py")
+        shutil.copy(local_path, remote_path)
+        return remote_path
+
+    def run(self, command, log):
+        """Run a shell command in the host directory and return its exit code."""
+        return subprocess.call(command, shell=True, cwd=self.workdir, stdout=log, stderr=subprocess.STDOUT)
+
+    def close(self):
+        """Remove the host directory."""
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+TRANSPORTS = {"ssh": SSHTransport, "local": LocalTransport}
+
+def load_inventory(path):
+    """Load the fleet inventory.
+
+    A JSON list of entries such as
+    {"host": "10.0.0.5", "hostname": "kvm-01", "interface": "eno1"} or
+    {"host": "10.0.0.6", "hostname": "kvm-02", "bond_slaves": ["eno1", "eno2"], "mtu": 9000},
+    with optional "bond_mode" and "no_stp". "bond_slaves" may also be a comma separated string.
+    """
+    with open(path) as f:
+        inventory = json.load(f)
+    for entry in inventory:
+        if "host" not in entry or "hostname" not in entry:
+            raise ValueError(f"Inventory entry {entry} needs both 'host' and 'hostname'.")
+        if "interface" not in entry and "bond_slaves" not in entry:
+            raise ValueError(f"Inventory entry for {entry['host']} needs 'interface' or 'bond_slaves'.")
+        bond_slaves = entry.get("bond_slaves")
+        if isinstance(bond_slaves, list) and all(isinstance(slave, str) for slave in bond_slaves):
+            entry["bond_slaves"] = ",".join(bond_slaves)
+        elif bond_slaves is not None and not isinstance(bond_slaves, str):
+            raise ValueError(f"Inventory entry for {entry['host']}: 'bond_slaves' must be a list of interface names "
+                             "or a comma separated string.")
+    return inventory
+
+def build_install_args(entry):
+    """Return the non-interactive command line arguments for one inventory entry."""
+    install_args = ["--hostname", entry["hostname"], "--no-reboot"]
+    if "bond_slaves" in entry:
+        install_args += ["--bond-slaves", entry["bond_slaves"], "--bond-mode", entry.get("bond_mode", "802.3ad")]
+    else:
+        install_args += ["--interface", entry["interface"]]
+    if entry.get("mtu"):
+        install_args += ["--mtu", str(entry["mtu"])]
+    if entry.get("no_stp"):
+        install_args.append("--no-stp")
+    return install_args
+
+def print_progress(inventory, states, changed_host=None):
+    """Print the per-host progress table, redrawing it in place on a terminal.
+
+    When stdout is not a terminal only the changed host is printed so logs stay readable.
+    """
+    if changed_host and not sys.stdout.isatty():
+        print(f"{changed_host}: {states[changed_host]}", flush=True)
+        return
+    lines = [f"{'HOST':<24}{'HOSTNAME':<24}STATUS", "-" * 64]
+    lines += [f"{entry['host']:<24}{entry['hostname']:<24}{states[entry['host']]}" for entry in inventory]
+    if changed_host:
+        sys.stdout.write(f"\033[{len(lines)}F\033[J")
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+def run_fleet(inventory, transport_name="ssh", user="root", workers=8, reboot_stagger=30,
+              reboot_command=None, script_path=None, log_dir="install-kvm-logs"):
+    """Install KVM on every inventory host with a bounded worker pool and staggered reboots.
+
+    reboot_command defaults to the transport's own (none for the local stand-in).
+    Returns the hosts that failed, including those whose reboot failed.
+    """
+    transport_class = TRANSPORTS[transport_name]
+    if getattr(transport_class, "requires_remote_script", False) and not script_path:
+        raise ValueError(f"The {transport_name} transport needs an explicit stand-in installer (--remote-script).")
+    script_path = script_path or os.path.abspath(__file__)
+    if reboot_command is None:
+        reboot_command = transport_class.default_reboot_command
+    os.makedirs(log_dir, exist_ok=True)
+
+    states = {entry["host"]: "pending" for entry in inventory}
+    lock = threading.Lock()
+    reboot_queue = queue.Queue()
+    reboot_failures = []
+    transports = []
+    print_progress(inventory, states)
+
+    def set_state(host, state):
+        with lock:
+            states[host] = state
+            print_progress(inventory, states, host)
+
+    def log_path(host):
+        return os.path.join(log_dir, f"{host}.log")
+
+    def reboot_hosts():
+        # runs beside the pool so hosts waiting for a reboot slot do not hold install workers
+        next_reboot = 0.0
+        while True:
+            item = reboot_queue.get()
+            if item is None:
+                return
+            host, transport = item
+            time.sleep(max(0.0, next_reboot - time.monotonic()))
+            try:
+                with open(log_path(host), "a") as log:
+                    transport.run(reboot_command, log)
+                set_state(host, "rebooted")
+            except Exception as e:
+                reboot_failures.append(host)
+                set_state(host, f"reboot failed ({e})")
+            next_reboot = time.monotonic() + reboot_stagger
+
+    def install(entry):
+        host = entry["host"]
+        with open(log_path(host), "w") as log:
+            try:
+                transport = transport_class(host, user)
+                with lock:
+                    transports.append(transport)
+                set_state(host, "copying")
+                remote_path = transport.stage(script_path, log)
+                set_state(host, "installing")
+                command = " ".join(shlex.quote(arg) for arg in ["python3", remote_path, *build_install_args(entry)])
+                if transport.run(command, log) != 0:
+                    set_state(host, f"failed (see {log.name})")
+                    return False
+                if reboot_command:
+                    set_state(host, "waiting to reboot")
+                    reboot_queue.put((host, transport))
+                else:
+                    set_state(host, "installed")
+                return True
+            except Exception as e:
+                log.write(f"{e}\n")
+                set_state(host, f"failed ({e})")
+                return False
+
+    reboot_thread = threading.Thread(target=reboot_hosts)
+    reboot_thread.start()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(install, inventory))
+    finally:
+        reboot_queue.put(None)
+        reboot_thread.join()
+        for transport in transports:
+            transport.close()
+
+    return [entry["host"] for entry, ok in zip(inventory, results) if not ok] + reboot_failures
+
+# Parse command line arguments
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Install KVM on Rocky Linux 9 and move the uplink onto bridge br0.')
+    parser.add_argument('--bond-slaves', help='Comma separated interfaces to bond (LACP) as the bridge uplink.')
+    parser.add_argument('--bond-mode', default='802.3ad', help='Bonding mode of bond0 when --bond-slaves is set (default: 802.3ad).')
+    parser.add_argument('--mtu', type=int, help='MTU for the bridge, bond and uplinks, e.g. 9000 for jumbo frames.')
+    parser.add_argument('--no-stp', action='store_true', help='Disable STP and the forwarding delay on br0.')
+    parser.add_argument('--nmcli', default='nmcli', help='nmcli binary to use (default: nmcli).')
+    parser.add_argument('--dry-run', action='store_true', help='Print the bridge commands instead of running them.')
+    parser.add_argument('--hostname', help='New host name of this server (skips the prompt).')
+    parser.add_argument('--interface', help='Network interface to add to the bridge (skips the prompt).')
+    parser.add_argument('--no-reboot', action='store_true', help='Do not reboot when the installation ends.')
+    parser.add_argument('--fleet', metavar='INVENTORY', help='Install on every host of a JSON inventory instead of this server.')
+    parser.add_argument('--workers', type=int, default=8, help='Hosts installed concurrently in fleet mode (default: 8).')
+    parser.add_argument('--transport', choices=sorted(TRANSPORTS), default='ssh', help='Fleet transport (default: ssh).')
+    parser.add_argument('--ssh-user', default='root', help='Remote user for the ssh transport (default: root).')
+    parser.add_argument('--reboot-stagger', type=int, default=30, help='Seconds between fleet reboots (default: 30).')
+    parser.add_argument('--reboot-command', help='Command used to reboot fleet hosts; empty to skip '
+                                                 '(default: systemctl reboot over ssh, none for the local transport).')
+    parser.add_argument('--remote-script', help='Installer copied to fleet hosts (default: this script; '
+                                                'required for the local transport).')
+    parser.add_argument('--log-dir', default='install-kvm-logs', help='Directory for per-host fleet logs.')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+
+    if args.fleet:
+        try:
+            failed = run_fleet(load_inventory(args.fleet), args.transport, args.ssh_user, args.workers,
+                               args.reboot_stagger, args.reboot_command, args.remote_script, args.log_dir)
+        except ValueError as e:
+            print(f"\033[91m{e}\033[0m")  # Red color for error messages
+            exit(1)
+        if failed:
+            print(f"\033[91mInstallation or reboot failed on: {', '.join(failed)}\033[0m")  # Red color for error messages
+            exit(1)
+        return
+
+    if args.dry_run:
+        interfaces = args.bond_slaves.split(',') if args.bond_slaves else [args.interface or input("Network interface to add to the bridge: ")]
+        bond_mode = args.bond_mode if args.bond_slaves else None
+        info = get_connection_info(interfaces[0], args.nmcli)
+        for command in build_bridge_commands(interfaces, info, args.nmcli, args.mtu, bond_mode, not args.no_stp):
+            print(command)
+        return
 
-# List of essential commands to check
-required_commands = ["nmcli", "dnf", "hostnamectl"]
-for cmd in required_commands:
-    check_command_exists(cmd)
+    # Check the OS version before running the rest of the script
+    check_os_version()
 
-# Get host name input
-host_name = input("Input new host name of this server: ")
+    # List of essential commands to check
+    required_commands = [args.nmcli, "dnf", "hostnamectl"]
+    for cmd in required_commands:
+        check_command_exists(cmd)
 
-# Update hostname
-run_command(f"hostnamectl set-hostname {host_name}")
+    # Get host name input
+    host_name = args.hostname or input("Input new host name of this server: ")
 
-# Disable IPv6 in /etc/hosts
-with open('/etc/hosts', 'r+') as f:
-    hosts = f.read()
-    if '::1' in hosts:
-        hosts = hosts.replace('::1', '#::1')
-        f.seek(0)
-        f.write(hosts)
-        f.truncate()
+    # Update hostname
+    run_command(f"hostnamectl set-hostname {host_name}")
 
-# Update the OS and install virtualization packages
-run_command("dnf install -y epel-release")
-run_command("dnf update -y")
-run_command("dnf install qemu-kvm libvirt virt-manager virt-install virt-top libguestfs-tools bridge-utils virt-viewer -y")
+    # Disable IPv6 in /etc/hosts
+    with open('/etc/hosts', 'r+') as f:
+        hosts = f.read()
+        if '::1' in hosts:
+            hosts = hosts.replace('::1', '#::1')
+            f.seek(0)
+            f.write(hosts)
+            f.truncate()
 
-# Start and enable libvirt service
-run_command("systemctl enable --now libvirtd")
+    # Update the OS and install virtualization packages
+    run_command("dnf install -y epel-release")
+    run_command("dnf update -y")
+    run_command("dnf install qemu-kvm libvirt virt-manager virt-install virt-top libguestfs-tools bridge-utils virt-viewer -y")
 
-# Gather network information
-ip_addr = subprocess.getoutput("hostname -I | awk '{print $1}'")
-gateway = subprocess.getoutput("/sbin/ip route | awk '/default/ { print $3 }' | head -1")
-dns1 = subprocess.getoutput("grep nameserver /etc/resolv.conf | sed -n 1p | awk '{print $2}'")
-dns2 = subprocess.getoutput("grep nameserver /etc/resolv.conf | sed -n 2p | awk '{print $2}'")
+    # Start and enable libvirt service
+    run_command("systemctl enable --now libvirtd")
 
-# Create the bridge using nmcli
-run_command("nmcli connection add type bridge autoconnect yes con-name br0 ifname br0")
-run_command(f"nmcli connection modify br0 ipv4.addresses {ip_addr}/24 ipv4.gateway {gateway} ipv4.dns {dns1} +ipv4.dns {dns2} ipv4.method manual")
+    # Make sure virtio-net guests get the in-kernel vhost-net backend
+    for command in build_vhost_net_commands():
+        run_command(command)
 
-# Bring up the bridge
-run_command("nmcli connection up br0")
+    # Get the interface(s) to be added to the bridge
+    bond_mode = args.bond_mode if args.bond_slaves else None
+    if args.bond_slaves:
+        interfaces = args.bond_slaves.split(',')
+    elif args.interface:
+        interfaces = [args.interface]
+    else:
+        # List active network interfaces
+        network_interfaces = subprocess.getoutput(f"{args.nmcli} device status | grep connected | awk '{{print $1}}'")
+        print("Available network interfaces:\n" + network_interfaces)
+        interfaces = [input("Please input the network interface you want to add to the bridge (e.g., eth0, enp3s0, etc): ")]
 
-# List active network interfaces
-network_interfaces = subprocess.getoutput("nmcli device status | grep connected | awk '{print $1}'")
-print("Available network interfaces:\n" + network_interfaces)
+    # Gather network information from the live connection
+    info = get_connection_info(interfaces[0], args.nmcli)
 
-# Get the interface to be added to the bridge
-interface = input("Please input the network interface you want to add to the bridge (e.g., eth0, enp3s0, etc): ")
+    # Create the bridge and move the uplink onto it
+    for command in build_bridge_commands(interfaces, info, args.nmcli, args.mtu, bond_mode, not args.no_stp):
+        run_command(command)
 
-# Add the selected interface to the bridge
-run_command(f"nmcli connection add type bridge-slave autoconnect yes con-name {interface}-slave ifname {interface} master br0")
+    if args.no_reboot:
+        print("The installation of KVM ends now. Reboot the OS to finish.")
+        return
 
-# Bring up the bridge again after adding the interface
-run_command("nmcli connection up br0")
+    # Prompt to reboot
+    input("The installation of KVM ends now and OS needs to be rebooted. Press any key to reboot the OS...")
 
-# Prompt to reboot
-input("The installation of KVM ends now and OS needs to be rebooted. Press any key to reboot the OS...")
+    # Reboot the system
+    run_command("reboot")
 
-# Reboot the system
-run_command("reboot")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import base64
+import hashlib
+import argparse
+import functools
+import tempfile
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Plan Jenkins plugin upgrades offline from a cached update-center.json and
+# prefetch the planned .hpi files into a shared, checksum-verified cache.
+
+@functools.lru_cache(maxsize=None)
+def version_key(version):
+    """Turn a plugin version such as 5.2.1, 1.0-beta-1 or 1228.v2c5dd70ed7a_6 into a comparable tuple."""
+    key = []
+    for part in re.split(r"[.\-_]", version):
+        key.append((2, int(part)) if part.isdigit() else (0, part))
+    key.append((1,))  # a release sorts after its qualifiers: 1.0 > 1.0-beta
+    return tuple(key)
+
+def load_update_center(path):
+    """Load a cached update-center.json, with or without the JSONP wrapper."""
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith("updateCenter.post("):
+        text = text[len("updateCenter.post("):text.rindex(")")]
+    return json.loads(text)
+
+def load_installed(path):
+    """Load the installed plugins of one controller as {name: version}.
+
+    Accepts the JSON of /pluginManager/api/json?tree=plugins[shortName,version]
+    or a plugins.txt style file with one name:version per line.
+    """
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith("{"):
+        return {plugin["shortName"]: plugin["version"] for plugin in json.loads(text)["plugins"]}
+    installed = {}
+    for line in text.splitlines():
+        line = line.split("#")[0].strip()
+        if line:
+            name, _, version = line.partition(":")
+            installed[name.strip()] = version.strip()
+    return installed
+
+def plan_upgrades(update_center, installed, core_version, pins=(), only=None):
+    """Compute the minimal, dependency ordered set of plugin upgrades for one controller.
+
+    Returns (plan, blocked): plan is a list of {"name", "from", "to", "url", "sha256", "sha1"}
+    with dependencies before their dependents, blocked maps a plugin to the reason
+    it cannot be upgraded.
+    """
+    plugins = update_center["plugins"]
+    core_key = version_key(core_version)
+    selected = {}
+    order = []
+    resolving = set()
+    blocked = {}
+
+    def resolve(name):
+        if name in selected or name in resolving:
+            return True
+        if name in blocked:
+            return False
+        entry = plugins.get(name)
+        if entry is None:
+            blocked[name] = "not in update center"
+            return False
+        if name in pins:
+            blocked[name] = "pinned"
+            return False
+        if version_key(entry.get("requiredCore", "0")) > core_key:
+            blocked[name] = f"requires Jenkins {entry['requiredCore']}"
+            return False
+
+        resolving.add(name)
+        start = len(order)
+        for dependency in entry.get("dependencies", []):
+            dependency_name = dependency["name"]
+            if dependency.get("optional") and dependency_name not in installed:
+                continue
+            current = installed.get(dependency_name)
+            if current and version_key(current) >= version_key(dependency["version"]):
+                continue
+            available = plugins.get(dependency_name, {}).get("version")
+            if available is None or version_key(available) < version_key(dependency["version"]):
+                blocked[name] = f"needs {dependency_name} {dependency['version']} which is not available"
+            elif not resolve(dependency_name):
+                blocked[name] = f"needs {dependency_name} {dependency['version']} ({blocked[dependency_name]})"
+            if name in blocked:
+                # roll back the dependencies pulled in only for this plugin
+                for rolled_back in order[start:]:
+                    del selected[rolled_back]
+                del order[start:]
+                resolving.discard(name)
+                return False
+        resolving.discard(name)
+
+        if name not in installed or version_key(entry["version"]) > version_key(installed[name]):
+            selected[name] = entry
+            order.append(name)
+        return True
+
+    if only is None:
+        only = sorted(name for name, version in installed.items()
+                      if name in plugins and version_key(plugins[name]["version"]) > version_key(version))
+    for name in only:
+        resolve(name)
+
+    plan = [{
+        "name": name,
+        "from": installed.get(name),
+        "to": selected[name]["version"],
+        "url": selected[name]["url"],
+        "sha256": selected[name].get("sha256"),
+        "sha1": selected[name].get("sha1"),
+    } for name in order]
+    return plan, blocked
+
+def cache_path(cache_dir, item):
+    """Return where the .hpi of a plan item lives in the shared cache."""
+    return os.path.join(cache_dir, item["name"], item["to"], f"{item['name']}.hpi")
+
+def expected_checksum(item):
+    """Return (algorithm, base64 digest) to verify a plan item with: SHA-256, else SHA-1."""
+    for algorithm in ("sha256", "sha1"):
+        if item.get(algorithm):
+            return algorithm, item[algorithm]
+    raise ValueError(f"no checksum for {item['name']} {item['to']} in the update center, refusing to cache it")
+
+def file_digest(path, algorithm):
+    """Return the base64 encoded digest of a file, as used by update-center.json."""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode()
+
+def fetch_plugin(cache_dir, item):
+    """Download one .hpi into the cache unless a verified copy is already there."""
+    algorithm, expected = expected_checksum(item)
+    path = cache_path(cache_dir, item)
+    if os.path.exists(path) and file_digest(path, algorithm) == expected:
+        return path, "cached"
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+    try:
+        digest = hashlib.new(algorithm)
+        with os.fdopen(fd, "wb") as out_file, urllib.request.urlopen(item["url"], timeout=60) as response:
+            for chunk in iter(lambda: response.read(1024 * 1024), b""):
+                digest.update(chunk)
+                out_file.write(chunk)
+        checksum = base64.b64encode(digest.digest()).decode()
+        if checksum != expected:
+            raise ValueError(f"checksum mismatch for {item['name']} {item['to']}")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path, "downloaded"
+
+def prefetch(cache_dir, plans, workers=8):
+    """Fetch every distinct .hpi of all plans in parallel. Return the items that failed."""
+    items = {}
+    for plan in plans:
+        for item in plan:
+            items[(item["name"], item["to"])] = item
+
+    def fetch(item):
+        try:
+            path, status = fetch_plugin(cache_dir, item)
+            print(f"{status}: {path}")
+            return None
+        except Exception as e:
+            print(f"failed: {item['name']} {item['to']}: {e}")
+            return item
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [item for item in executor.map(fetch, items.values()) if item]
+
+def print_plan(controller, plan, blocked):
+    """Print the plan of one controller."""
+    print(f"== {controller}: {len(plan)} upgrade(s), {len(blocked)} blocked")
+    for item in plan:
+        print(f"  {item['name']:<40}{item['from'] or '(new)':>24} -> {item['to']}")
+    for name, reason in sorted(blocked.items()):
+        print(f"  {name:<40}blocked: {reason}")
+
+# Parse command line arguments
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Plan Jenkins plugin upgrades offline and prefetch the .hpi files.')
+    parser.add_argument('--update-center', required=True, help='Path of a cached update-center.json.')
+    parser.add_argument('--installed', nargs='+', required=True, help='Installed plugin list of each controller (JSON or plugins.txt).')
+    parser.add_argument('--core-version', required=True, help='Jenkins core version the plugins must run on.')
+    parser.add_argument('--pin', action='append', default=[], help='Plugin to keep at its installed version (repeatable).')
+    parser.add_argument('--only', action='append', help='Only upgrade these plugins and what they need (repeatable).')
+    parser.add_argument('--json', action='store_true', help='Print the plans as JSON.')
+    parser.add_argument('--cache-dir', help='Prefetch the planned .hpi files into this shared cache.')
+    parser.add_argument('--workers', type=int, default=8, help='Parallel downloads when prefetching (default: 8).')
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    update_center = load_update_center(args.update_center)
+    results = {}
+    for path in args.installed:
+        plan, blocked = plan_upgrades(update_center, load_installed(path), args.core_version, set(args.pin), args.only)
+        results[path] = {"plan": plan, "blocked": blocked}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for controller, result in results.items():
+            print_plan(controller, result["plan"], result["blocked"])
+
+    if args.cache_dir:
+        failed = prefetch(args.cache_dir, [result["plan"] for result in results.values()], args.workers)
+        if failed:
+            exit(1)
@@ -1,29 +1,86 @@
 import os
 import time
 import json
+import random
+import threading
 import requests
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
-
-# Please install the (selenium) library before running
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Please install the (selenium) library before running the Selenium fallback
+try:
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.common.keys import Keys
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException, NoSuchElementException
+except ImportError:
+    webdriver = None
+
+# Staged rollout over many controllers: path of a JSON inventory, see run_rollout()
+JENKINS_INVENTORY = os.getenv("JENKINS_INVENTORY")
+CANARY_SIZE = int(os.getenv("CANARY_SIZE", "1"))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "5"))
+MAX_CONCURRENT_RESTARTS = int(os.getenv("MAX_CONCURRENT_RESTARTS", "2"))
 
 # Get HOST_IP from environment variables
 host_ip = os.getenv("HOST_IP")
-if not host_ip:
+if not host_ip and not JENKINS_INVENTORY:
     raise RuntimeError("HOST_IP environment variable is not set.")
 
 # Configuration
 MANAGER_URL = f"http://{host_ip}:4444/wd/hub"
-print(f"Selenium HUB URL: {MANAGER_URL}")
 
-# Set JENKINS_URL using HOST_IP
-JENKINS_URL = f"https://{host_ip}:8443"
-print(f"Jenkins URL: {JENKINS_URL}")
+# Set JENKINS_URL using HOST_IP unless it is given explicitly
+JENKINS_URL = os.getenv("JENKINS_URL") or f"https://{host_ip}:8443"
+
+if not JENKINS_INVENTORY:
+    print(f"Selenium HUB URL: {MANAGER_URL}")
+    print(f"Jenkins URL: {JENKINS_URL}")
+
+# Upgrade engine: "rest" talks to the Jenkins HTTP API and falls back to "selenium" on failure
+UPGRADE_ENGINE = os.getenv("UPGRADE_ENGINE", "rest")
+
+def wait_until(condition, timeout, initial_interval=0.5, max_interval=10):
+    """Call condition() with exponential backoff and jitter until it returns a truthy value.
+
+    Returns that value, or None when the timeout expires first.
+    """
+    end_time = time.monotonic() + timeout
+    interval = initial_interval
+    while True:
+        result = condition()
+        if result:
+            return result
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(remaining, random.uniform(interval / 2, interval)))
+        interval = min(interval * 2, max_interval)
+
+class PhaseTimer:
+    """Record how long each phase of an upgrade actually took."""
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.monotonic() - start
+
+    def summary(self):
+        return ", ".join(f"{name} {duration:.1f}s" for name, duration in self.durations.items())
+
+# Pooled connection to the Selenium manager, reused across polls
+manager_session = requests.Session()
 
 # Get selenium hub ip address
 def get_selenium_hub():
@@ -37,35 +94,308 @@ def get_selenium_hub():
     else:
         return None
 
-    for _ in range(60):
+    def hub_ready():
         data = {
             'build_url': build_url,
             'load': load
         }
-        json_data = json.dumps(data)
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(MANAGER_URL, data=json_data, headers=headers)
+        response = manager_session.post(MANAGER_URL, json=data, timeout=30)
         res_dir = json.loads(response.text)
         if res_dir.get("result") == "ready":
             return res_dir.get("selenium_hub")
-        time.sleep(5)
-    return None
+        return None
+
+    return wait_until(hub_ready, timeout=300, initial_interval=1)
 
-# Determine SELENIUM_GRID_URL based on HOST_LOCALE
+# Credentials of each HOST_LOCALE
+CREDENTIALS = {
+    "aws_test": ("aauto_task", "c60$8Fwwic"),
+    "chengdu": ("test", "123.com@123"),
+}
+
+# Determine credentials based on HOST_LOCALE
 host_locale = os.getenv("HOST_LOCALE")
-if host_locale == "aws_test":
-    SELENIUM_GRID_URL = get_selenium_hub()
-    USERNAME = "aauto_task"
-    PASSWORD = "c60$8Fwwic"
-    if SELENIUM_GRID_URL is None:
-        raise RuntimeError("Failed to obtain Selenium Hub URL for aws_test.")
-elif host_locale == "chengdu":
-    SELENIUM_GRID_URL = f"http://{host_ip}:4444/wd/hub"
-    USERNAME = "test"
-    PASSWORD = "123.com@123"
-else:
+if host_locale in CREDENTIALS:
+    USERNAME, PASSWORD = CREDENTIALS[host_locale]
+elif not JENKINS_INVENTORY:
     raise RuntimeError("Unsupported HOST_LOCALE value.")
 
+def get_selenium_grid_url():
+    """Determine SELENIUM_GRID_URL based on HOST_LOCALE."""
+    if host_locale == "aws_test":
+        selenium_grid_url = get_selenium_hub()
+        if selenium_grid_url is None:
+            raise RuntimeError("Failed to obtain Selenium Hub URL for aws_test.")
+        return selenium_grid_url
+    return f"http://{host_ip}:4444/wd/hub"
+
+class JenkinsApiError(Exception):
+    """Raised when a Jenkins HTTP endpoint does not answer as expected."""
+
+# Asks the controller's own update center data, which follows its LTS or weekly stream
+CORE_UPDATE_SCRIPT = """
+def data = jenkins.model.Jenkins.get().updateCenter.coreSource?.data
+println(data != null && data.hasCoreUpdates() ? data.core.version : "")
+"""
+
+class JenkinsClient:
+    """Crumb-authenticated Jenkins HTTP API client over a pooled requests.Session."""
+
+    def __init__(self, base_url, username, password, verify=False, pool_size=4, name=None):
+        self.base_url = base_url.rstrip("/")
+        self.name = name
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.verify = verify
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.crumb_loaded = False
+        self.timer = PhaseTimer()
+
+    def log(self, message):
+        """Print a message, prefixed with the controller name when there is one."""
+        print(f"[{self.name}] {message}" if self.name else message)
+
+    def load_crumb(self):
+        """Fetch a CSRF crumb and send it with every later request of this session."""
+        response = self.session.get(f"{self.base_url}/crumbIssuer/api/json", timeout=30)
+        if response.status_code == 200:
+            crumb = response.json()
+            self.session.headers[crumb["crumbRequestField"]] = crumb["crumb"]
+        elif response.status_code != 404:  # 404 means CSRF protection is disabled
+            raise JenkinsApiError(f"GET /crumbIssuer/api/json returned HTTP {response.status_code}")
+        self.crumb_loaded = True
+
+    def request(self, method, path, **kwargs):
+        """Send a request to Jenkins and raise JenkinsApiError on an HTTP error."""
+        if method != "GET" and not self.crumb_loaded:
+            self.load_crumb()
+        kwargs.setdefault("timeout", 30)
+        response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+        if response.status_code >= 400:
+            raise JenkinsApiError(f"{method} {path} returned HTTP {response.status_code}")
+        return response
+
+    def version(self):
+        """Return the running Jenkins core version."""
+        version = self.request("GET", "/api/json", params={"tree": "mode"}).headers.get("X-Jenkins")
+        if not version:
+            raise JenkinsApiError("Jenkins did not report its version.")
+        return version
+
+    def core_update(self):
+        """Return the newer core version the controller's update center offers, or None."""
+        latest = self.request("POST", "/scriptText", data={"script": CORE_UPDATE_SCRIPT}).text.strip()
+        return latest or None
+
+    def check_updates(self):
+        """Make Jenkins refresh its update center metadata."""
+        self.request("POST", "/pluginManager/checkUpdatesServer", allow_redirects=False)
+
+    def plugin_updates(self):
+        """Return the short names of installed plugins that have an update."""
+        plugins = self.request("GET", "/pluginManager/api/json", params={"tree": "plugins[shortName,hasUpdate]"}).json()["plugins"]
+        return [plugin["shortName"] for plugin in plugins if plugin.get("hasUpdate")]
+
+    def install_plugins(self, names):
+        """Queue the latest version of every named plugin for installation."""
+        form = {f"plugin.{name}.default": "on" for name in names}
+        self.request("POST", "/pluginManager/install", data=form, allow_redirects=False)
+
+    def upgrade_core(self):
+        """Queue the download of the newest Jenkins core."""
+        self.request("POST", "/updateCenter/upgrade", allow_redirects=False)
+
+    def update_jobs(self):
+        """Return every update center job since Jenkins started."""
+        return self.request("GET", "/updateCenter/api/json", params={"tree": "jobs[id,type,status[type]]"}).json()["jobs"]
+
+    def last_update_job_id(self):
+        """Return the id of the newest update center job, so later waits can ignore older jobs."""
+        return max((job["id"] for job in self.update_jobs()), default=-1)
+
+    def update_jobs_done(self, since_id=-1):
+        """Return True when no update center job newer than since_id is pending and raise if one failed."""
+        jobs = [job for job in self.update_jobs() if job["id"] > since_id]
+        states = [job["status"].get("type") for job in jobs if job.get("status")]
+        failed = [state for state in states if state == "Failure"]
+        if failed:
+            raise JenkinsApiError(f"{len(failed)} update center job(s) failed.")
+        return all(state not in ("Pending", "Installing") for state in states)
+
+    def wait_for_update_jobs(self, since_id=-1, timeout=600):
+        """Wait until every update center job newer than since_id has finished and raise if one failed."""
+        if not wait_until(lambda: self.update_jobs_done(since_id), timeout):
+            raise JenkinsApiError("Timeout waiting for update center jobs.")
+
+    def is_ready(self):
+        """Probe the lightweight login page: True when Jenkins serves requests."""
+        try:
+            return self.session.get(f"{self.base_url}/login", timeout=5).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def busy_executors(self):
+        """Return the number of executors currently running a build."""
+        return self.request("GET", "/computer/api/json", params={"tree": "busyExecutors"}).json()["busyExecutors"]
+
+    def cancel_quiet_down(self):
+        """Let Jenkins start new builds again; best effort, errors are only logged."""
+        try:
+            self.request("POST", "/cancelQuietDown", allow_redirects=False)
+        except (requests.RequestException, JenkinsApiError) as e:
+            self.log(f"Could not cancel quiet down: {e}")
+
+    def wait_for_idle(self, timeout=1800):
+        """Stop new builds from starting and wait until all executors are idle.
+
+        Quiet mode is cancelled again when the builds do not drain.
+        """
+        self.request("POST", "/quietDown", allow_redirects=False)
+        try:
+            if not wait_until(lambda: self.busy_executors() == 0, timeout, initial_interval=2, max_interval=30):
+                raise JenkinsApiError("Timeout waiting for running builds to finish.")
+        except Exception:
+            self.cancel_quiet_down()
+            raise
+
+    def restart(self):
+        """Request a safe restart of a drained Jenkins, cancelling quiet mode if the request fails."""
+        try:
+            self.request("POST", "/safeRestart", allow_redirects=False)
+        except Exception:
+            self.cancel_quiet_down()
+            raise
+
+    def is_healthy(self):
+        """Return True when Jenkins answers and every enabled plugin is active."""
+        if not self.is_ready():
+            return False
+        try:
+            plugins = self.request("GET", "/pluginManager/api/json", params={"tree": "plugins[shortName,active,enabled]"}).json()["plugins"]
+        except (requests.RequestException, JenkinsApiError, KeyError, ValueError):
+            return False
+        failed = [plugin["shortName"] for plugin in plugins if plugin.get("enabled") and not plugin.get("active")]
+        if failed:
+            self.log(f"Plugins failed to load: {', '.join(failed)}")
+        return not failed
+
+    def wait_for_restart(self, down_timeout=120, timeout=600):
+        """Wait until Jenkins went down for the restart and answers again.
+
+        Returns False when Jenkins never went down within down_timeout or did not come back within timeout.
+        """
+        with self.timer.phase("restart"):
+            if not wait_until(lambda: not self.is_ready(), down_timeout, initial_interval=0.2, max_interval=2):
+                self.log(f"Jenkins did not go down for the restart within {down_timeout}s")
+                return False
+            self.crumb_loaded = False  # crumbs do not survive a restart
+            return bool(wait_until(self.is_ready, timeout))
+
+def upgrade_jenkins_version_rest(client):
+    """Upgrade Jenkins version through the HTTP API. Return True when a restart is needed."""
+    with client.timer.phase("core update check"):
+        client.check_updates()
+        latest = client.core_update()
+    if not latest:
+        client.log("Jenkins core is up to date")
+        return False
+    with client.timer.phase("core download"):
+        since_id = client.last_update_job_id()
+        client.upgrade_core()
+        client.wait_for_update_jobs(since_id)
+    client.log(f"Downloaded Jenkins {latest} (running {client.version()})")
+    return True
+
+def upgrade_jenkins_plugins_rest(client):
+    """Upgrade Jenkins plugins through the HTTP API. Return True when a restart is needed."""
+    with client.timer.phase("plugin update check"):
+        names = client.plugin_updates()
+    if not names:
+        client.log("All plugins are up to date")
+        return False
+    with client.timer.phase("plugin download"):
+        since_id = client.last_update_job_id()
+        client.install_plugins(names)
+        client.wait_for_update_jobs(since_id)
+    client.log(f"Downloaded {len(names)} plugin update(s): {', '.join(names)}")
+    return True
+
+def upgrade_jenkins_rest(client, restart_slots=None):
+    """Upgrade Jenkins core and plugins, then do a single safe restart.
+
+    restart_slots is an optional semaphore that bounds how many controllers restart at once.
+    """
+    restart_needed = upgrade_jenkins_version_rest(client)
+    restart_needed = upgrade_jenkins_plugins_rest(client) or restart_needed
+    if not restart_needed:
+        return
+    # drain builds before taking a restart slot so long builds do not hold one
+    with client.timer.phase("wait for idle executors"):
+        client.wait_for_idle()
+    with restart_slots or nullcontext():
+        client.restart()
+        client.log("Requested safe restart of Jenkins")
+        if not client.wait_for_restart():
+            raise JenkinsApiError("Timeout waiting for Jenkins to come back after restart.")
+    client.log("Jenkins restart complete")
+
+def load_inventory(path):
+    """Load the controller inventory: a JSON list of {"name", "url", "locale"} or
+    {"name", "url", "username", "password"} entries, in rollout order."""
+    with open(path) as f:
+        inventory = json.load(f)
+    for controller in inventory:
+        if "url" not in controller:
+            raise ValueError(f"Inventory entry {controller} has no 'url'.")
+        if "username" not in controller and controller.get("locale") not in CREDENTIALS:
+            raise ValueError(f"Inventory entry {controller['url']} needs credentials or a known 'locale'.")
+    return inventory
+
+def plan_waves(inventory, canary_size=1, batch_size=5):
+    """Split the inventory into a canary wave followed by batches."""
+    waves = [inventory[:canary_size]] if canary_size > 0 else []
+    rest = inventory[canary_size:] if canary_size > 0 else inventory
+    waves += [rest[i:i + batch_size] for i in range(0, len(rest), batch_size)]
+    return [wave for wave in waves if wave]
+
+def run_rollout(inventory, canary_size=1, batch_size=5, max_concurrent_restarts=2):
+    """Upgrade the controllers wave by wave, stopping when a wave fails its health check.
+
+    Every controller keeps one authenticated session for the core and plugin steps.
+    Returns {controller name: status}.
+    """
+    restart_slots = threading.BoundedSemaphore(max_concurrent_restarts)
+    results = {controller.get("name", controller["url"]): "skipped" for controller in inventory}
+
+    def upgrade(controller):
+        username, password = (controller["username"], controller["password"]) if "username" in controller \
+            else CREDENTIALS[controller["locale"]]
+        client = JenkinsClient(controller["url"], username, password, name=controller.get("name", controller["url"]))
+        try:
+            upgrade_jenkins_rest(client, restart_slots)
+            with client.timer.phase("health check"):
+                healthy = client.is_healthy()
+            status = "upgraded" if healthy else "unhealthy"
+        except (requests.RequestException, JenkinsApiError, KeyError, ValueError) as e:
+            client.log(f"Upgrade failed: {e}")
+            status = "failed"
+        client.log(f"{status}; phase timings: {client.timer.summary()}")
+        return client.name, status
+
+    waves = plan_waves(inventory, canary_size, batch_size)
+    for number, wave in enumerate(waves, 1):
+        print(f"Wave {number}/{len(waves)}: {', '.join(controller.get('name', controller['url']) for controller in wave)}")
+        with ThreadPoolExecutor(max_workers=len(wave)) as executor:
+            wave_results = dict(executor.map(upgrade, wave))
+        results.update(wave_results)
+        if any(status != "upgraded" for status in wave_results.values()):
+            print(f"Wave {number} failed its health check, stopping the rollout")
+            break
+    return results
+
 def login_to_jenkins(driver):
     """Log in to Jenkins."""
     driver.get(f"{JENKINS_URL}/login")
@@ -76,34 +406,23 @@ def login_to_jenkins(driver):
     driver.find_element(By.NAME, "j_password").send_keys(Keys.RETURN)
 
     WebDriverWait(driver, 20).until(EC.text_to_be_present_in_element((By.TAG_NAME, "body"), "Welcome to the test env"))
-    time.sleep(10)
-
-def wait_for_text_in_body(driver, text, timeout=600, interval=2):
-    """Refresh the page every interval seconds until the specified text is found in the body or timeout occurs."""
-    end_time = time.time() + timeout
-    while time.time() < end_time:
-        driver.refresh()
-        if text in driver.find_element(By.TAG_NAME, "body").text:
-            return True
-        time.sleep(interval)
-    return False
-
-def wait_for_login_page(driver, timeout=300, interval=2):
-    """Wait until the login page is displayed."""
-    end_time = time.time() + timeout
-    while time.time() < end_time:
-        try:
-            driver.refresh()
-            WebDriverWait(driver, interval).until(EC.presence_of_element_located((By.NAME, "j_username")))
-            return True
-        except TimeoutException:
-            pass
-    return False
 
-def upgrade_jenkins_version(driver):
+def wait_for_login_page(driver, client, timeout=300):
+    """Wait for Jenkins to restart over HTTP probes, then load the login page once."""
+    if not client.wait_for_restart(down_timeout=timeout, timeout=timeout):
+        return False
+    driver.get(f"{JENKINS_URL}/login")
+    try:
+        WebDriverWait(driver, 20).until(EC.presence_of_element_located((By.NAME, "j_username")))
+        return True
+    except TimeoutException:
+        return False
+
+def upgrade_jenkins_version(driver, client):
     """Upgrade Jenkins version."""
     try:
-        login_to_jenkins(driver)
+        with client.timer.phase("login"):
+            login_to_jenkins(driver)
 
         driver.get(f"{JENKINS_URL}/manage")
         WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
@@ -140,7 +459,7 @@ def upgrade_jenkins_version(driver):
         print("Jenkins version upgrade complete")
 
         # Wait for the login page to reappear
-        if wait_for_login_page(driver):
+        if wait_for_login_page(driver, client):
             print("Login page reappeared after upgrade")
         else:
             print("Timeout waiting for login page after upgrade")
@@ -152,10 +471,11 @@ def upgrade_jenkins_version(driver):
     except Exception as e:
         print(f"Other exception: {e}")
 
-def upgrade_jenkins_plugins(driver):
+def upgrade_jenkins_plugins(driver, client):
     """Upgrade Jenkins plugins."""
     try:
-        login_to_jenkins(driver)
+        with client.timer.phase("login"):
+            login_to_jenkins(driver)
 
         driver.get(f"{JENKINS_URL}/pluginManager")
         WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "filter-box")))
@@ -199,11 +519,11 @@ def upgrade_jenkins_plugins(driver):
         except TimeoutException:
             print("Timeout waiting for checkbox label")
 
-        # Wait for Jenkins to restart
-        if wait_for_text_in_body(driver, "Please wait while Jenkins is restarting"):
+        # Wait for Jenkins to finish the downloads, restart and answer again
+        if client.wait_for_restart(down_timeout=600):
             print("Jenkins restart complete")
         else:
-            print("Timeout: Did not find 'Please wait while Jenkins is restarting'")
+            print("Timeout waiting for Jenkins to restart")
 
     except TimeoutException as e:
         print(f"Timeout exception: {e}")
@@ -212,17 +532,42 @@ def upgrade_jenkins_plugins(driver):
     except Exception as e:
         print(f"Other exception: {e}")
 
-if __name__ == "__main__":
+def upgrade_jenkins_selenium():
+    """Upgrade Jenkins version and plugins by driving a browser on the Selenium grid."""
+    if webdriver is None:
+        raise RuntimeError("The selenium library is required for the Selenium upgrade engine.")
+
     chrome_options = Options()
     chrome_options.add_argument("--no-sandbox")
     chrome_options.add_argument("--start-maximized")
     chrome_options.add_argument("--disable-dev-shm-usage")
     chrome_options.add_argument("--ignore-certificate-errors")
 
-    driver = webdriver.Remote(command_executor=SELENIUM_GRID_URL, options=chrome_options)
+    client = JenkinsClient(JENKINS_URL, USERNAME, PASSWORD)
+    with client.timer.phase("selenium hub"):
+        driver = webdriver.Remote(command_executor=get_selenium_grid_url(), options=chrome_options)
 
     try:
-        upgrade_jenkins_version(driver)
-        upgrade_jenkins_plugins(driver)
+        upgrade_jenkins_version(driver, client)
+        upgrade_jenkins_plugins(driver, client)
     finally:
         driver.quit()
+        print(f"Phase timings: {client.timer.summary()}")
+
+if __name__ == "__main__":
+    if JENKINS_INVENTORY:
+        results = run_rollout(load_inventory(JENKINS_INVENTORY), CANARY_SIZE, BATCH_SIZE, MAX_CONCURRENT_RESTARTS)
+        for name, status in results.items():
+            print(f"{name}: {status}")
+        if any(status != "upgraded" for status in results.values()):
+            exit(1)
+    elif UPGRADE_ENGINE == "rest":
+        client = JenkinsClient(JENKINS_URL, USERNAME, PASSWORD)
+        try:
+            upgrade_jenkins_rest(client)
+            print(f"Phase timings: {client.timer.summary()}")
+        except (requests.RequestException, JenkinsApiError, KeyError, ValueError) as e:
+            print(f"REST upgrade failed ({e}), falling back to Selenium")
+            upgrade_jenkins_selenium()
+    else:
+        upgrade_jenkins_selenium()